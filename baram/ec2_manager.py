@@ -1,16 +1,105 @@
-import traceback
+import asyncio
+import copy
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 
-import boto3
+from botocore.exceptions import ClientError
 
 from baram.log_manager import LogManager
+from baram.session_manager import SessionManager
+
+
+def _ttl_cached(func):
+    """
+    Cache the result of an EC2Manager method for EC2Manager.CACHE_TTL_SECS seconds.
+    None is not cached so that failed describes are retried on the next call.
+    Callers get a shallow copy, so adding or removing items does not change the cached result.
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        with self._cache_lock:
+            hit = self._cache.get(key)
+        if hit is not None and hit[0] > time.monotonic():
+            return copy.copy(hit[1])
+        result = func(self, *args, **kwargs)
+        if result is not None:
+            with self._cache_lock:
+                self._cache[key] = (time.monotonic() + self.CACHE_TTL_SECS, result)
+        return copy.copy(result)
+
+    return wrapper
 
 
 class EC2Manager(object):
+    MAX_WORKERS = 16
+    CACHE_TTL_SECS = 600
+    # name indexes built from a cached list_* result, dropped together with it.
+    DERIVED_CACHES = {'list_sgs': ('_sg_ids_by_name',),
+                      'list_vpcs': ('_vpc_ids_by_name',),
+                      'list_subnets': ('_subnet_ids_by_vpc_and_name',)}
+
     def __init__(self):
-        self.cli = boto3.client('ec2')
+        self.cli = SessionManager.get_client('ec2', config=SessionManager.POOLED_CONFIG)
+        self.executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+        self._cache = {}
+        self._cache_lock = threading.Lock()
 
         self.logger = LogManager.get_logger()
 
+    def _map_api_calls(self, func, items: list) -> list:
+        """
+        Call func for each item concurrently, logging ClientError per item instead of stopping the others.
+
+        :param func: function to call with each item
+        :param items: arguments of func
+        :return: results, None for failed items
+        """
+
+        def call(item):
+            try:
+                return func(item)
+            except ClientError:
+                self.logger.exception(f'failed to call {func.__name__} for {item}')
+                return None
+
+        return list(self.executor.map(call, items))
+
+    def invalidate_cache(self, *method_names: str):
+        """
+        Drop cached describe results, e.g. right after mutating ec2 resources.
+
+        :param method_names: cached method names to drop. ex) 'list_key_pairs'. drop all if empty.
+        """
+        method_names = set(method_names).union(*[self.DERIVED_CACHES.get(m, ()) for m in method_names])
+        with self._cache_lock:
+            if not method_names:
+                self._cache.clear()
+                return
+            for key in [k for k in self._cache if k[0] in method_names]:
+                self._cache.pop(key, None)
+
+    @_ttl_cached
+    def _describe_instances_cached(self) -> dict:
+        return self.describe_instances()
+
+    def _iter_instances(self, state: str = None):
+        """
+        Yield every instance of every reservation, optionally only those in specific state.
+
+        :param state: instance state name (ex: 'running', ...). all states if None.
+        :return: Instance generator
+        """
+        reservations = self._describe_instances_cached()['Reservations']
+        for instance in chain.from_iterable(r['Instances'] for r in reservations):
+            if state is None or instance['State']['Name'] == state:
+                yield instance
+
+    @_ttl_cached
     def list_sgs(self) -> list:
         """
         Describes the specified security groups or all of your security groups.
@@ -18,9 +107,9 @@ class EC2Manager(object):
         :return: SecurityGroups
         """
         try:
-            return self.cli.describe_security_groups()['SecurityGroups']
-        except:
-            print(traceback.format_exc())
+            return SessionManager.paginate(self.cli, 'describe_security_groups', 'SecurityGroups')
+        except ClientError:
+            self.logger.exception('failed to describe security groups')
             return None
 
     def list_unused_sg_ids(self, description_filter: str = '', sm_domain_ids: list = None) -> set:
@@ -66,7 +155,7 @@ class EC2Manager(object):
             return result
 
         except TypeError:
-            print(traceback.format_exc())
+            self.logger.exception('failed to pair vpc, security group, eni and subnet')
             return None
 
     def get_default_vpc(self) -> list:
@@ -84,11 +173,11 @@ class EC2Manager(object):
         :param vpc_id: VpcId
         :return: GroupId
         """
-        sgs = self.cli.describe_security_groups()['SecurityGroups']
+        sgs = self.list_sgs()
         try:
             return [sg['GroupId'] for sg in sgs if sg['VpcId'] == vpc_id]
         except TypeError:
-            print(traceback.format_exc())
+            self.logger.exception(f'failed to get security groups of {vpc_id}')
             return None
 
     def get_eni_with_sg_id(self, sg_id: str) -> list:
@@ -102,7 +191,7 @@ class EC2Manager(object):
         try:
             return [eni for eni in enis if eni['Groups'] != [] and sg_id in [x['GroupId'] for x in eni['Groups']]]
         except TypeError:
-            print(traceback.format_exc())
+            self.logger.exception(f'failed to get network interfaces of {sg_id}')
             return None
 
     def list_sg_relations(self) -> list:
@@ -164,8 +253,8 @@ class EC2Manager(object):
                     self.cli.revoke_security_group_ingress(GroupId=sg_id,
                                                            SecurityGroupRuleIds=[sg_rule['sg_rule_id']])
                 self.logger.info('security group rule has deleted')
-        except:
-            print(traceback.format_exc())
+        except ClientError:
+            self.logger.exception(f'failed to delete security group rules of {sg_id}')
 
     def delete_sgs(self, sg_ids: list):
         """
@@ -174,12 +263,9 @@ class EC2Manager(object):
         :param sg_ids: List of GroupId.
         :return:
         """
-        try:
-            for sg_id in sg_ids:
-                self.delete_sg_rules(sg_id)
-                self.delete_sg(sg_id)
-        except:
-            print(traceback.format_exc())
+        for sg_id in sg_ids:
+            self.delete_sg_rules(sg_id)
+            self.delete_sg(sg_id)
 
     def delete_sg(self, sg_id: str):
         """
@@ -188,10 +274,11 @@ class EC2Manager(object):
         :param sg_id: GroupId
         """
         try:
-            self.cli.delete_sg(GroupId=sg_id)
+            self.cli.delete_security_group(GroupId=sg_id)
+            self.invalidate_cache('list_sgs')
             self.logger.info('security group has deleted')
-        except:
-            print(traceback.format_exc())
+        except ClientError:
+            self.logger.exception(f'failed to delete security group {sg_id}')
 
     def list_instances_with_status(self, status: str = 'running'):
         """
@@ -200,23 +287,25 @@ class EC2Manager(object):
         :return: Instances, with status
         """
         try:
-            instances = [instance['Instances'][0] for instance in self.describe_instances()['Reservations']]
-            return [instance for instance in instances if instance['State']['Name'] == status]
-        except:
-            print(traceback.format_exc())
+            return list(self._iter_instances(state=status))
+        except ClientError:
+            self.logger.exception('failed to describe instances')
             return None
 
     def delete_unused_key_pairs(self):
         """
         Delete redundant key pairs (i.e. not related to any instances)
         """
+        # never delete based on cached inventory; an instance may have started using a key pair since.
+        self.invalidate_cache('list_key_pairs', '_describe_instances_cached')
         key_pairs_redundant = self.list_unused_key_pairs()
-        try:
-            for key_pair in key_pairs_redundant:
-                self.cli.delete_key_pair(KeyName=key_pair)
-                self.logger.info('key pair has deleted')
-        except:
-            print(traceback.format_exc())
+
+        def delete_key_pair(key_pair: str):
+            self.cli.delete_key_pair(KeyName=key_pair)
+            self.logger.info('key pair has deleted')
+
+        self._map_api_calls(delete_key_pair, list(key_pairs_redundant))
+        self.invalidate_cache('list_key_pairs')
 
     def list_unused_key_pairs(self):
         """
@@ -225,11 +314,23 @@ class EC2Manager(object):
         :return: KeyName
         """
         key_pairs_total = self.list_key_pairs()
-        instances = [instance['Instances'][0] for instance in self.describe_instances()['Reservations']]
-        key_pairs_using = [instance['KeyName'] for instance in instances if 'KeyName' in instance]
+        key_pairs_using = {instance['KeyName'] for instance in self._iter_instances() if 'KeyName' in instance}
+
+        return key_pairs_total - key_pairs_using
+
+    async def list_unused_key_pairs_async(self):
+        """
+        Describes all disused key pairs, fetching key pairs and instances concurrently.
 
-        return key_pairs_total - set(key_pairs_using)
+        :return: KeyName
+        """
+        key_pairs_total, response = await asyncio.gather(asyncio.to_thread(self.list_key_pairs),
+                                                         asyncio.to_thread(self._describe_instances_cached))
+        key_pairs_using = {i['KeyName'] for r in response['Reservations'] for i in r['Instances'] if 'KeyName' in i}
 
+        return key_pairs_total - key_pairs_using
+
+    @_ttl_cached
     def list_key_pairs(self):
         """
         Describes all key pairs
@@ -239,13 +340,14 @@ class EC2Manager(object):
         key_pairs = self.cli.describe_key_pairs()['KeyPairs']
         return set([key_pair['KeyName'] for key_pair in key_pairs])
 
+    @_ttl_cached
     def list_vpcs(self) -> list:
         """
         List one or more of your VPCs.
 
         :return: Vpcs
         """
-        return self.cli.describe_vpcs()['Vpcs']
+        return SessionManager.paginate(self.cli, 'describe_vpcs', 'Vpcs')
 
     def list_detail_vpcs(self) -> list:
         """
@@ -267,13 +369,14 @@ class EC2Manager(object):
                  'state': vpc['State']})
         return vpc_list
 
+    @_ttl_cached
     def list_subnets(self) -> list:
         """
         List one or more of your Subnets.
 
         :return: Subnets
         """
-        return self.cli.describe_subnets()['Subnets']
+        return SessionManager.paginate(self.cli, 'describe_subnets', 'Subnets')
 
     def list_detail_subnets(self) -> list:
         """
@@ -322,26 +425,56 @@ class EC2Manager(object):
         """
         return self.cli.describe_transit_gateways()['TransitGateways']
 
+    @_ttl_cached
+    def _sg_ids_by_name(self) -> dict:
+        sg_ids = {}
+        for i in self.list_sgs():
+            sg_ids.setdefault(i['GroupName'].lower(), i['GroupId'])
+        return sg_ids
+
+    @_ttl_cached
+    def _vpc_ids_by_name(self) -> dict:
+        vpc_ids = {}
+        for i in self.list_vpcs():
+            for t in i.get('Tags', []):
+                vpc_ids.setdefault(t['Value'].lower(), i['VpcId'])
+        return vpc_ids
+
+    @_ttl_cached
+    def _subnet_ids_by_vpc_and_name(self) -> dict:
+        subnet_ids = {}
+        for s in self.list_subnets():
+            for t in s.get('Tags', []):
+                subnet_ids.setdefault((s['VpcId'], t['Value']), s['SubnetId'])
+        return subnet_ids
+
     def get_sg_id_with_sg_name(self, group_name: str) -> str:
         """
         Retrieve subnet id from group name.
+        Exact (case-insensitive) name match first, then the first group whose name contains group_name.
 
         :param group_name: GroupName
         :return: GroupId
         """
-        return next(
-            (i['GroupId'] for i in self.cli.describe_security_groups()['SecurityGroups']
-             if group_name.lower() in i['GroupName'].lower()), None)
+        needle = group_name.lower()
+        sg_ids = self._sg_ids_by_name()
+        if needle in sg_ids:
+            return sg_ids[needle]
+        return next((v for k, v in sg_ids.items() if needle in k), None)
 
     def get_vpc_id_with_vpc_name(self, vpc_name: str) -> str:
         """
         Retrieve vpc id from vpc name
+        Exact (case-insensitive) tag value match first, then the first vpc whose tag value contains vpc_name.
 
         :param vpc_name: vpc name
         :return:
         """
-        return next(i['VpcId'] for i in self.list_vpcs() if 'Tags' in i
-                    for t in i['Tags'] if vpc_name.lower() in t['Value'].lower())
+        needle = vpc_name.lower()
+        vpc_ids = self._vpc_ids_by_name()
+        if needle in vpc_ids:
+            return vpc_ids[needle]
+        return next(v for k, v in vpc_ids.items() if needle in k)
 
     def get_subnet_id(self, vpc_id: str, subnet_name: str) -> str:
         """
@@ -351,8 +484,7 @@ class EC2Manager(object):
         :param subnet_name: subnet_name
         :return:
         """
-        return next(s['SubnetId'] for s in self.list_subnets() if vpc_id == s['VpcId'] and 'Tags' in s
-                    for t in s['Tags'] if subnet_name == t['Value'])
+        return self._subnet_ids_by_vpc_and_name()[(vpc_id, subnet_name)]
 
     def get_ec2_id_with_ec2_name(self, ec2_name: str) -> str:
         """
@@ -360,31 +492,34 @@ class EC2Manager(object):
         :param ec2_name: ec2 instance name
         :return:
         """
-        ec2 = boto3.resource('ec2')
-        return next(
-            i.id for i in ec2.instances.all() if i.state['Name'] == 'running' for t in i.tags if ec2_name == t['Value'])
+        reservations = SessionManager.iter_pages(self.cli, 'describe_instances', 'Reservations',
+                                                 Filters=[{'Name': 'tag-value', 'Values': [ec2_name]},
+                                                          {'Name': 'instance-state-name', 'Values': ['running']}])
+        return next(i['InstanceId'] for r in reservations for i in r['Instances'])
 
-    def describe_instances(self, instance_id_list: list = None) -> list:
+    def describe_instances(self, instance_id_list: list = None) -> dict:
         """
 
         Retrieve ec2 instance description.
         :param instance_id_list: ec2 instance id list
-        :return:
+        :return: {'Reservations': reservations of every page}. other keys of the raw response
+                 (ex: ResponseMetadata) are not included.
         """
         if instance_id_list is not None:
-            return self.cli.describe_instances(InstanceIds=instance_id_list)
+            reservations = SessionManager.paginate(self.cli, 'describe_instances', 'Reservations',
+                                                   InstanceIds=instance_id_list)
         else:
-            return self.cli.describe_instances()
+            reservations = SessionManager.paginate(self.cli, 'describe_instances', 'Reservations',
+                                                   PaginationConfig={'PageSize': 1000})
+        return {'Reservations': reservations}
 
     def get_ec2_instances_with_imds_v1(self) -> list:
         """
 
         :return: get ec2 instances that support imds_v1.
         """
-        response = self.describe_instances()
-        return [i['InstanceId'] for r in response['Reservations']
-                for i in r['Instances']
-                if i['MetadataOptions']['HttpTokens'] != 'required' and i['State']['Name'] == 'running']
+        return [i['InstanceId'] for i in self._iter_instances(state='running')
+                if i['MetadataOptions']['HttpTokens'] != 'required']
 
     def apply_imdsv2_only_mode(self,
                                instances_list: list = None,
@@ -394,13 +529,18 @@ class EC2Manager(object):
         Apply imdsv2 only mode into ec2 instances.
         :param instances_list:
         :param http_put_response_hop_limit: see https://docs.aws.amazon.com/AWSEC2/latest/APIReference/API_InstanceMetadataOptionsRequest.html.
-        :return:
+        :return: instance ids that failed to apply imdsv2 only mode
         """
-        for i in instances_list:
-            self.cli.modify_instance_metadata_options(InstanceId=i,
-                                                      HttpTokens='required',
-                                                      HttpPutResponseHopLimit=http_put_response_hop_limit,
-                                                      HttpEndpoint='enabled')
+
+        def modify_instance_metadata_options(instance_id: str):
+            return self.cli.modify_instance_metadata_options(InstanceId=instance_id,
+                                                             HttpTokens='required',
+                                                             HttpPutResponseHopLimit=http_put_response_hop_limit,
+                                                             HttpEndpoint='enabled')
+
+        responses = self._map_api_calls(modify_instance_metadata_options, instances_list)
+        self.invalidate_cache('_describe_instances_cached')
+        return [i for i, response in zip(instances_list, responses) if response is None]
 
     def delete_vpc(self, vpc_id: str):
         """
@@ -2,7 +2,6 @@ import os
 from pathlib import Path
 
 import boto3
-import fire
 
 from baram.iam_manager import IAMManager
 from baram.log_manager import LogManager
@@ -258,4 +257,6 @@ class GlueManager(object):
 
 
 if __name__ == '__main__':
+    import fire
+
     fire.Fire(GlueManager)
@@ -1,4 +1,3 @@
-import fire
 import boto3
 
 from baram.log_manager import LogManager
@@ -108,4 +107,6 @@ class IAMManager(object):
 
 
 if __name__ == '__main__':
+    import fire
+
     fire.Fire(IAMManager)
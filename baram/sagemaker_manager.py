@@ -1,14 +1,20 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
-import boto3
+from botocore.exceptions import ClientError
 
 from baram.log_manager import LogManager
+from baram.session_manager import SessionManager
 
 
 class SagemakerManager(object):
+    MIN_POLL_DELAY_SECS = 5
+    MAX_POLL_DELAY_SECS = 60
+    MAX_WORKERS = 8
+
     def __init__(self, domain_id: str = None):
-        self.cli = boto3.client('sagemaker')
+        self.cli = SessionManager.get_client('sagemaker', config=SessionManager.POOLED_CONFIG)
         self.domain_id = domain_id
         self.logger = LogManager.get_logger('SagemakerManager')
 
@@ -16,9 +22,9 @@ class SagemakerManager(object):
                            domain_id: Optional[str] = None,
                            **kwargs):
         domain_id = domain_id if domain_id else self.domain_id
-        response = self.cli.list_user_profiles(DomainIdEquals=domain_id,
-                                               **kwargs)
-        return response['UserProfiles']
+        return SessionManager.paginate(self.cli, 'list_user_profiles', 'UserProfiles',
+                                       DomainIdEquals=domain_id,
+                                       **kwargs)
 
     def describe_user_profile(self,
                               user_profile_name: str,
@@ -32,12 +38,12 @@ class SagemakerManager(object):
                   domain_id: Optional[str] = None,
                   **kwargs):
         domain_id = domain_id if domain_id else self.domain_id
-        response = self.cli.list_apps(DomainIdEquals=domain_id,
-                                      SortBy='CreationTime',
-                                      SortOrder='Descending',
-                                      MaxResults=100,
-                                      **kwargs)
-        return response['Apps']
+        return SessionManager.paginate(self.cli, 'list_apps', 'Apps',
+                                       DomainIdEquals=domain_id,
+                                       SortBy='CreationTime',
+                                       SortOrder='Descending',
+                                       PaginationConfig={'PageSize': 100},
+                                       **kwargs)
 
     def delete_app(self,
                    user_profile_name: str,
@@ -106,70 +112,112 @@ class SagemakerManager(object):
         apps = self.list_apps(domain_id=domain_id,
                               UserProfileNameEquals=user_profile_name)
         for app in apps:
-            try:
-                response = self.describe_app(user_profile_name=user_profile_name,
-                                             app_name=app['AppName'],
-                                             app_type=app['AppType'],
-                                             domain_id=domain_id)
-                if response['Status'] != 'Deleted' and response['Status'] != 'Deleting':
-                    self.delete_app(user_profile_name=user_profile_name,
-                                    app_name=app['AppName'],
-                                    app_type=app['AppType'],
-                                    domain_id=domain_id)
-            except self.cli.exceptions.ResourceNotFound:
-                pass
-            except self.cli.exceptions.ResourceInUse as e:
-                self.logger.info(e)
-                return
+            if app['Status'] != 'Deleted' and app['Status'] != 'Deleting':
+                self.delete_app(user_profile_name=user_profile_name,
+                                app_name=app['AppName'],
+                                app_type=app['AppType'],
+                                domain_id=domain_id)
         self.logger.info(f'deleting {len(apps)} apps.')
-        delete_cnt = 0
+        remaining = {(app['AppName'], app['AppType']) for app in apps}
+        delay_secs = self.MIN_POLL_DELAY_SECS
         elapsed_secs = 0
-        while delete_cnt < len(apps):
-            delete_cnt = 0
-            for app in apps:
-                response = self.describe_app(user_profile_name=user_profile_name,
-                                             app_name=app['AppName'],
-                                             app_type=app['AppType'],
-                                             domain_id=domain_id)
-                self.logger.info(f'status = {response["Status"]}')
-                if response['Status'] == 'Deleted' or response['Status'] == 'Failed':
-                    delete_cnt += 1
-            time.sleep(5)
-            elapsed_secs += 5
-            self.logger.info(f'wait 5 seconds. delete_cnt={delete_cnt}, elapsed_secs={elapsed_secs}')
+        while remaining:
+            # apps are sorted by CreationTime descending, so keep the latest status of each app.
+            statuses = {}
+            for app in self.list_apps(domain_id=domain_id,
+                                      UserProfileNameEquals=user_profile_name):
+                statuses.setdefault((app['AppName'], app['AppType']), app['Status'])
+            self.logger.info(f'statuses = {[(k[0], statuses.get(k)) for k in remaining]}')
+            remaining = {k for k in remaining if statuses.get(k, 'Deleted') not in ('Deleted', 'Failed')}
+            if remaining:
+                time.sleep(delay_secs)
+                elapsed_secs += delay_secs
+                self.logger.info(f'wait {delay_secs} seconds. remaining={len(remaining)}, elapsed_secs={elapsed_secs}')
+                delay_secs = min(delay_secs * 2, self.MAX_POLL_DELAY_SECS)
         return self.cli.delete_user_profile(DomainId=domain_id, UserProfileName=user_profile_name)
 
     def recreate_all_user_profiles(self,
                                    is_sso_domain: Optional[bool] = False,
-                                   domain_id: Optional[str] = None):
+                                   domain_id: Optional[str] = None) -> list:
+        """
+        Delete and create again every user profile of the domain with the same execution role.
+
+        :param is_sso_domain: whether the domain uses sso
+        :param domain_id: DomainId
+        :return: names of user profiles that failed to recreate
+        """
         domain_id = domain_id if domain_id else self.domain_id
-        user_profiles = [self.describe_user_profile(user_profile_name=x['UserProfileName'], domain_id=domain_id)
-                         for x in self.list_user_profiles(domain_id=domain_id)]
-        self.logger.info(f"user profiles to recreate: {[x['UserProfileName'] for x in user_profiles]}")
+        user_profile_names = [x['UserProfileName'] for x in self.list_user_profiles(domain_id=domain_id)]
+        self.logger.info(f"user profiles to recreate: {user_profile_names}")
 
-        for i in user_profiles:
-            self.logger.info(f"start deleting {i['UserProfileName']}")
-            self.delete_user_profile(user_profile_name=i['UserProfileName'],
-                                     domain_id=domain_id)
-            while i['UserProfileName'] in self.list_user_profiles(domain_id=domain_id):
-                time.sleep(5)
-            else:
-                self.logger.info(f"{i['UserProfileName']} deleted")
-                time.sleep(5)
+        def recreate(user_profile: dict):
+            user_profile_name = user_profile['UserProfileName']
+            try:
+                self.logger.info(f"start deleting {user_profile_name}")
+                self.delete_user_profile(user_profile_name=user_profile_name,
+                                         domain_id=domain_id)
+                if not self.wait_user_profile_deleted(user_profile_name=user_profile_name,
+                                                      domain_id=domain_id):
+                    self.logger.error(f"{user_profile_name} is not deleted. skip recreating.")
+                    return user_profile_name
+                self.logger.info(f"{user_profile_name} deleted")
                 if is_sso_domain:
-                    self.create_user_profile(user_profile_name=i['UserProfileName'],
-                                             execution_role=i['UserSettings']['ExecutionRole'],
+                    self.create_user_profile(user_profile_name=user_profile_name,
+                                             execution_role=user_profile['UserSettings']['ExecutionRole'],
                                              domain_id=domain_id,
                                              is_sso_domain=is_sso_domain,
-                                             sso_user_value=i['SingleSignOnUserValue'])
+                                             sso_user_value=user_profile['SingleSignOnUserValue'])
                 else:
-                    self.create_user_profile(user_profile_name=i['UserProfileName'],
-                                             execution_role=i['UserSettings']['ExecutionRole'],
+                    self.create_user_profile(user_profile_name=user_profile_name,
+                                             execution_role=user_profile['UserSettings']['ExecutionRole'],
                                              domain_id=domain_id)
-            self.logger.info(f"{i['UserProfileName']} created")
+                self.logger.info(f"{user_profile_name} created")
+            except ClientError:
+                self.logger.exception(f'failed to recreate {user_profile_name}')
+                return user_profile_name
+            return None
+
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            # read every execution role before deleting any profile.
+            user_profiles = list(executor.map(
+                lambda x: self.describe_user_profile(user_profile_name=x, domain_id=domain_id), user_profile_names))
+            failed = [x for x in executor.map(recreate, user_profiles) if x is not None]
+        if failed:
+            self.logger.error(f'user profiles failed to recreate: {failed}')
+        return failed
+
+    def wait_user_profile_deleted(self,
+                                  user_profile_name: str,
+                                  domain_id: Optional[str] = None,
+                                  delay_secs: int = 5,
+                                  max_attempts: int = 120) -> bool:
+        """
+        Wait until the user profile is gone after its deletion was requested.
+
+        :param user_profile_name: UserProfileName
+        :param domain_id: DomainId
+        :param delay_secs: seconds between polls
+        :param max_attempts: number of polls before giving up
+        :return: True if deleted, False if deletion failed or did not finish in time
+        """
+        domain_id = domain_id if domain_id else self.domain_id
+        for _ in range(max_attempts):
+            try:
+                response = self.describe_user_profile(user_profile_name=user_profile_name,
+                                                      domain_id=domain_id)
+            except self.cli.exceptions.ResourceNotFound:
+                return True
+            # InService may still show right after the delete call, so only failures end the wait.
+            if response['Status'] in ('Failed', 'Delete_Failed'):
+                self.logger.error(f'{user_profile_name} status = {response["Status"]}')
+                return False
+            time.sleep(delay_secs)
+        self.logger.error(f'{user_profile_name} is not deleted after {delay_secs * max_attempts} seconds. '
+                          f'it may still be deleted later.')
+        return False
 
     def list_domains(self):
-        return self.cli.list_domains()['Domains']
+        return SessionManager.paginate(self.cli, 'list_domains', 'Domains')
 
     def delete_domain(self,
                       domain_id: Optional[str] = None):
@@ -0,0 +1,70 @@
+import threading
+from itertools import chain
+
+import boto3
+from botocore.config import Config
+
+
+class SessionManager(object):
+    # sized for the managers' thread pools; adaptive retries back off on throttling.
+    POOLED_CONFIG = Config(max_pool_connections=32, retries={'mode': 'adaptive', 'max_attempts': 10})
+
+    _session = None
+    _clients = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_session() -> boto3.session.Session:
+        """
+        Return the boto3 session shared by every manager.
+
+        :return: boto3 session
+        """
+        with SessionManager._lock:
+            if SessionManager._session is None:
+                SessionManager._session = boto3.session.Session()
+            return SessionManager._session
+
+    @staticmethod
+    def get_client(service_name: str, config=None):
+        """
+        Return a client of the shared session, created once per (service_name, config).
+        boto3 clients are thread-safe, so they can be reused by every manager instance.
+
+        :param service_name: aws service name. ex) ec2
+        :param config: botocore.config.Config
+        :return: boto3 client
+        """
+        session = SessionManager.get_session()
+        key = (service_name, config)
+        with SessionManager._lock:
+            if key not in SessionManager._clients:
+                SessionManager._clients[key] = session.client(service_name, config=config)
+            return SessionManager._clients[key]
+
+    @staticmethod
+    def iter_pages(cli, operation_name: str, result_key: str, **kwargs):
+        """
+        Yield result_key items of a paginated call, requesting the next page only when needed.
+
+        :param cli: boto3 client
+        :param operation_name: client method name. ex) describe_instances
+        :param result_key: list key of each page. ex) Reservations
+        :param kwargs: parameters of operation_name
+        :return: item generator
+        """
+        pages = cli.get_paginator(operation_name).paginate(**kwargs)
+        return chain.from_iterable(page[result_key] for page in pages)
+
+    @staticmethod
+    def paginate(cli, operation_name: str, result_key: str, **kwargs) -> list:
+        """
+        Collect result_key items of every page of a paginated call.
+
+        :param cli: boto3 client
+        :param operation_name: client method name. ex) list_apps
+        :param result_key: list key of each page. ex) Apps
+        :param kwargs: parameters of operation_name
+        :return: items of all pages
+        """
+        return list(SessionManager.iter_pages(cli, operation_name, result_key, **kwargs))
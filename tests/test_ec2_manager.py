@@ -1,3 +1,4 @@
+import asyncio
 import json
 from pprint import pprint
 
@@ -312,3 +313,24 @@ def test_list_tgws(em):
     assert type(tgws) == list
     if len(tgws) != 0:
         assert type(tgws[0]['TransitGatewayId']) == str
+
+
+def test_invalidate_cache(em):
+    # Given
+    em.list_key_pairs()
+    em.list_vpcs()
+
+    # When
+    em.invalidate_cache('list_key_pairs')
+
+    # Then
+    assert [k[0] for k in em._cache] == ['list_vpcs']
+
+
+def test_list_unused_key_pairs_async(em):
+    # When
+    unused_key_pairs = asyncio.run(em.list_unused_key_pairs_async())
+    pprint(unused_key_pairs)
+
+    # Then
+    assert type(unused_key_pairs) == set
@@ -0,0 +1,14 @@
+from baram.session_manager import SessionManager
+
+
+def test_get_session():
+    assert SessionManager.get_session() is SessionManager.get_session()
+
+
+def test_get_client():
+    # When
+    cli = SessionManager.get_client('ec2')
+
+    # Then
+    assert cli is SessionManager.get_client('ec2')
+    assert cli is not SessionManager.get_client('sagemaker')